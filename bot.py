@@ -1,9 +1,14 @@
 import asyncio
 import re
 import os
-from typing import Dict, Any, List, Optional
-
-from aiogram import Bot, Dispatcher, F
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Awaitable, Callable, List, Optional, Set, Tuple
+
+from aiogram import BaseMiddleware, Bot, Dispatcher, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.filters import BaseFilter
 from aiogram.types import (
     Message,
     ReplyKeyboardMarkup,
@@ -11,7 +16,9 @@ from aiogram.types import (
     InlineKeyboardMarkup,
     InlineKeyboardButton,
     CallbackQuery,
+    TelegramObject,
 )
+from aiohttp import FormData  # aiogram 3 работает поверх aiohttp
 
 # --- BOT TOKEN ---
 try:
@@ -26,15 +33,187 @@ if not BOT_TOKEN:
 import sessions
 import dish_parser
 import sheets
+from dish_parser import PriceItem
+
+class ConstMarkupSession(AiohttpSession):
+    """
+    Клавиатуры-константы (keyboard_*, edit_keyboard) не меняются, поэтому сериализуем
+    их в JSON один раз, а не на каждый send_* (model_dump + json_dumps всей клавиатуры).
+    Сам JSON строит aiogram (prepare_value) — формат не расходится с обычной отправкой.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self._const_markups: Dict[int, Any] = {}
+        self._serialized: Dict[int, str] = {}
+
+    def register_const_markups(self, *markups: Any) -> None:
+        for markup in markups:
+            self._const_markups[id(markup)] = markup
+
+    def build_form_data(self, bot: Bot, method: Any) -> FormData:
+        markup = getattr(method, "reply_markup", None)
+        if markup is None or id(markup) not in self._const_markups:
+            return super().build_form_data(bot, method)
 
-bot = Bot(token=BOT_TOKEN)
+        markup_json = self._serialized.get(id(markup))
+        if markup_json is None:
+            markup_json = self._serialized[id(markup)] = self.prepare_value(markup, bot=bot, files={})
+
+        # model_copy — поверхностная копия без сериализации; None-поля aiogram в форму не кладет
+        form = super().build_form_data(bot, method.model_copy(update={"reply_markup": None}))
+        form.add_field("reply_markup", markup_json)
+        return form
+
+
+_session = ConstMarkupSession()
+bot = Bot(token=BOT_TOKEN, session=_session)
 dp = Dispatcher()
 
 
+# -------------------------
+# Per-user очередь апдейтов
+# -------------------------
+
+class PerUserQueueMiddleware(BaseMiddleware):
+    """
+    Апдейты одного пользователя обрабатываются строго по очереди (важно для массовой
+    загрузки: фото и тексты должны лечь в buffer в том же порядке), а разные
+    пользователи — параллельно и не ждут чужих get_file / выгрузок.
+    Воркер пользователя завершается сам после IDLE_TIMEOUT секунд простоя.
+    """
+
+    IDLE_TIMEOUT = 60
+
+    def __init__(self) -> None:
+        self._queues: Dict[int, asyncio.Queue] = {}
+        self._workers: "Set[asyncio.Task]" = set()
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+
+        queue = self._queues.get(user.id)
+        if queue is None:
+            queue = self._queues[user.id] = asyncio.Queue()
+            worker = asyncio.create_task(self._worker(user.id, queue))
+            self._workers.add(worker)
+            worker.add_done_callback(self._workers.discard)
+
+        future = asyncio.get_running_loop().create_future()
+        await queue.put((handler, event, data, future))
+        return await future
+
+    async def _worker(self, user_id: int, queue: asyncio.Queue) -> None:
+        future = None
+        try:
+            while True:
+                try:
+                    handler, event, data, future = await asyncio.wait_for(queue.get(), self.IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    # между проверкой и удалением очереди (в finally) нет await — новый апдейт не потеряется
+                    if queue.empty():
+                        return
+                    continue
+
+                try:
+                    result = await handler(event, data)
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    if not future.done():
+                        future.set_result(result)
+                future = None
+        finally:
+            # воркер мог и упасть (BaseException из хендлера, отмена): очередь снимаем, чтобы следующий
+            # апдейт завел новый воркер, а ожидающим апдейтам отвечаем ошибкой — иначе они висят вечно
+            if self._queues.get(user_id) is queue:
+                del self._queues[user_id]
+            pending = [future] if future is not None else []
+            while not queue.empty():
+                pending.append(queue.get_nowait()[3])
+            for f in pending:
+                if not f.done():
+                    f.set_exception(RuntimeError(f"update worker for user {user_id} stopped"))
+
+
+_per_user_queue = PerUserQueueMiddleware()
+dp.message.outer_middleware(_per_user_queue)
+dp.callback_query.outer_middleware(_per_user_queue)
+
+_NON_DIGIT_RE = re.compile(r"\D")
+# строка правки цен "вес - цена": label до первого "-", остальное — цена (\s без \n, чтобы не склеивать строки)
+_PRICE_EDIT_LINE_RE = re.compile(r"^[^\S\n]*([^-\n]*?)[^\S\n]*-([^\n]*)$", re.MULTILINE)
+
+# file_id -> (file_path, время получения): повторное подтверждение той же картинки не ходит в Telegram API.
+# Bot API гарантирует ссылку getFile не меньше часа — запись старше _FILE_PATH_TTL запрашиваем заново
+_FILE_PATH_CACHE_MAX = 10_000
+_FILE_PATH_TTL = 50 * 60
+_file_path_cache: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+_FILE_PREFETCH_CONCURRENCY = 20
+_SEND_RETRY_ATTEMPTS = 3
+
+# фоновая выгрузка подтвержденных позиций: (user_id, sheet_url, menu, items).
+# menu — dict меню сессии, из которого ушли строки: упавшие возвращаются туда же
+_EXPORT_BATCH_ROWS = 50
+_export_queue: Optional["asyncio.Queue[Tuple[int, str, Dict[str, Any], List[Tuple[Any, ...]]]]"] = None
+
+
+class _PendingExports:
+    """Сколько пачек пользователя еще в фоновой выгрузке; idle выставляется, когда не осталось ни одной."""
+
+    __slots__ = ("count", "idle")
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.idle = asyncio.Event()
+
+
+# menu_ready ждет только свои пачки, а не всю общую очередь (чужие выгрузки и их ретраи)
+_export_pending: Dict[int, _PendingExports] = {}
+
+# ссылки на фоновые задачи, чтобы их не собрал GC до завершения
+_background_tasks: "Set[asyncio.Task]" = set()
+
+
 # -------------------------
 # UI
 # -------------------------
 
+_COMMA_TO_SPACE = str.maketrans(",", " ")
+
+_PRICE_SOURCE_LABELS = {
+    "multi_price_pairs": "нашел несколько вариантов цены (формат «вариант — цена»)",
+    "explicit_price_attr": "нашел цену по ключу «Цена»",
+    "fallback_from_text": "нашел цену в тексте",
+}
+
+_WEIGHT_SOURCE_LABELS = {
+    "explicit_weight_attr": "нашел вес по ключу «Вес»",
+    "labeled_weight_block": "нашел вес в отдельном поле",
+    "fallback_from_text": "определил вес из текста",
+}
+
+_COMPOSITION_SOURCE_LABELS = {
+    "composition_block": "взял состав из блока «Состав»",
+    "explicit_composition_attr": "взял состав из строки",
+    "description_used_as_composition": "использовал описание как состав",
+    "fallback_from_text": "собрал состав из текста",
+}
+
+_IKPU_SOURCE_LABELS = {
+    "explicit_key": "нашел ИКПУ по ключу",
+    "detected_anywhere": "нашел ИКПУ в тексте автоматически",
+}
+
+
 def explain_meta(meta: dict) -> str:
     lines = []
 
@@ -42,67 +221,41 @@ def explain_meta(meta: dict) -> str:
         lines.append("🔍 Сообщение распознано как структурированное")
 
     if meta.get("price_source"):
-        price_map = {
-            "multi_price_pairs": "нашел несколько вариантов цены (формат «вариант — цена»)",
-            "explicit_price_attr": "нашел цену по ключу «Цена»",
-            "fallback_from_text": "нашел цену в тексте",
-        }
-        lines.append("💰 Цена: " + price_map.get(meta["price_source"], meta["price_source"]))
+        lines.append("💰 Цена: " + _PRICE_SOURCE_LABELS.get(meta["price_source"], meta["price_source"]))
 
     if meta.get("weight_source"):
-        weight_map = {
-            "explicit_weight_attr": "нашел вес по ключу «Вес»",
-            "labeled_weight_block": "нашел вес в отдельном поле",
-            "fallback_from_text": "определил вес из текста",
-        }
-        lines.append("⚖️ Вес: " + weight_map.get(meta["weight_source"], meta["weight_source"]))
+        lines.append("⚖️ Вес: " + _WEIGHT_SOURCE_LABELS.get(meta["weight_source"], meta["weight_source"]))
 
     if meta.get("composition_source"):
-        comp_map = {
-            "composition_block": "взял состав из блока «Состав»",
-            "explicit_composition_attr": "взял состав из строки",
-            "description_used_as_composition": "использовал описание как состав",
-            "fallback_from_text": "собрал состав из текста",
-        }
-        lines.append("🧾 Состав: " + comp_map.get(meta["composition_source"], meta["composition_source"]))
+        lines.append("🧾 Состав: " + _COMPOSITION_SOURCE_LABELS.get(meta["composition_source"], meta["composition_source"]))
 
     if meta.get("ikpu_source"):
-        ikpu_map = {
-            "explicit_key": "нашел ИКПУ по ключу",
-            "detected_anywhere": "нашел ИКПУ в тексте автоматически",
-        }
-        lines.append("🏷 ИКПУ: " + ikpu_map.get(meta["ikpu_source"], "найден"))
+        lines.append("🏷 ИКПУ: " + _IKPU_SOURCE_LABELS.get(meta["ikpu_source"], "найден"))
 
     return "\n".join(lines)
 
 def render_dish_card(parsed: Dict[str, Any], photo_count: int) -> str:
-    prices_text = "—"
-    if parsed.get("prices"):
+    dash = "—"
+    g = parsed.get
+
+    prices_text = dash
+    prices = g("prices")
+    if prices:
         prices_text = "\n".join(
-        "{label} — {price}".format(
-            label=p.get("label") or p.get("weight") or "—",
-            price=str(p.get("price")).replace(",", " ")
+            f"{p.weight or dash} — {str(p.price).translate(_COMMA_TO_SPACE)}"
+            for p in prices
         )
-        for p in parsed["prices"]
-    )
-    elif parsed.get("price") is not None:
-        prices_text = str(parsed["price"]).replace(",", " ")
+    elif g("price") is not None:
+        prices_text = str(parsed["price"]).translate(_COMMA_TO_SPACE)
 
     return (
         "📦 Блюдо разобрано\n\n"
-        "Название: {name}\n"
-        "Состав: {comp}\n"
-        "Вес: {weight}\n"
-        "Цены:\n{prices}\n"
-        "ИКПУ: {ikpu}\n"
-        "Фото: {photos}".format(
-            name=parsed.get("name") or "—",
-            comp=parsed.get("composition") or "—",
-            weight=parsed.get("weight") or "—",
-            prices=prices_text,
-            ikpu=parsed.get("ikpu") or "—",
-            photos=photo_count,
-        )
+        f"Название: {g('name') or dash}\n"
+        f"Состав: {g('composition') or dash}\n"
+        f"Вес: {g('weight') or dash}\n"
+        f"Цены:\n{prices_text}\n"
+        f"ИКПУ: {g('ikpu') or dash}\n"
+        f"Фото: {photo_count}"
     )
 
 
@@ -152,6 +305,14 @@ edit_keyboard = InlineKeyboardMarkup(inline_keyboard=[
     ],
 ])
 
+_session.register_const_markups(
+    keyboard_start,
+    keyboard_manual_menu,
+    keyboard_bulk_collect,
+    keyboard_dish_collect,
+    edit_keyboard,
+)
+
 
 # -------------------------
 # Start / Home
@@ -205,22 +366,38 @@ async def bulk_start(message: Message):
 # Sheet link (routes by mode)
 # -------------------------
 
-@dp.message(F.text.startswith("https://docs.google.com/spreadsheets"))
+_SHEETS_PREFIX = "https://docs.google.com/spreadsheets"
+
+_EXPORT_IN_PROGRESS = "⏳ Меню уже выгружается, подожди немного."
+
+
+class SheetLinkFilter(BaseFilter):
+    """Прямой startswith вместо цепочки MagicFilter — фильтр проверяется на каждом тексте."""
+
+    async def __call__(self, message: Message) -> bool:
+        return message.text is not None and message.text.startswith(_SHEETS_PREFIX)
+
+
+@dp.message(SheetLinkFilter())
 async def set_sheet(message: Message):
-    if not sessions.get_session(message.from_user.id):
-        sessions.ensure_session(message.from_user.id)
+    s = sessions.ensure_session(message.from_user.id)
+
+    mode = sessions.get_mode(message.from_user.id, session=s)
+    if mode == "menu_export":
+        # меню выгружается в привязанную таблицу — ссылку не меняем, иначе остаток уйдет в другую
+        await message.answer(_EXPORT_IN_PROGRESS)
+        return
 
-    mode = sessions.get_mode(message.from_user.id)
     url = message.text.strip()
-    sessions.set_sheet_url(message.from_user.id, url)
+    sessions.set_sheet_url(message.from_user.id, url, session=s)
 
     if mode == "manual_wait_sheet":
-        sessions.set_mode(message.from_user.id, "manual_menu")
+        sessions.set_mode(message.from_user.id, "manual_menu", session=s)
         await message.answer("✅ Таблица привязана.\nТеперь добавляй блюда.", reply_markup=keyboard_manual_menu)
         return
 
     if mode == "bulk_wait_sheet":
-        sessions.set_mode(message.from_user.id, "bulk_collect")
+        sessions.set_mode(message.from_user.id, "bulk_collect", session=s)
         await message.answer(
             "✅ Таблица привязана.\n\n"
             "Теперь отправь ВСЁ меню подряд:\n"
@@ -242,12 +419,16 @@ async def set_sheet(message: Message):
 @dp.message(F.text == "➕ Новое блюдо")
 async def manual_new_dish(message: Message):
     s = sessions.get_session(message.from_user.id)
-    if not s or not s.get("menu", {}).get("sheet_url"):
+    if not s or not s.menu or not s.menu.get("sheet_url"):
         await message.answer("Сначала выбери режим и укажи ссылку на таблицу.", reply_markup=keyboard_start)
         return
 
-    sessions.reset_dish(message.from_user.id)
-    sessions.set_mode(message.from_user.id, "dish_collect")
+    if sessions.get_mode(message.from_user.id, session=s) == "menu_export":
+        await message.answer(_EXPORT_IN_PROGRESS)
+        return
+
+    sessions.reset_dish(message.from_user.id, session=s)
+    sessions.set_mode(message.from_user.id, "dish_collect", session=s)
     await message.answer(
         "Перешли данные и фото блюда.\nКогда закончишь — нажми «✔️ Готово».",
         reply_markup=keyboard_dish_collect
@@ -275,9 +456,9 @@ async def cancel_dish(message: Message):
 @dp.message(F.photo)
 async def collect_photo(message: Message):
     user_id = message.from_user.id
-    sessions.ensure_session(user_id)  # ✅ добавь
+    s = sessions.ensure_session(user_id)  # ✅ добавь
 
-    mode = sessions.get_mode(user_id)
+    mode = sessions.get_mode(user_id, session=s)
 
     if not message.photo:
         return
@@ -285,9 +466,9 @@ async def collect_photo(message: Message):
     file_id = message.photo[-1].file_id
 
     if mode == "dish_collect":
-        sessions.add_photo(user_id, file_id)
+        sessions.add_photo(user_id, file_id, session=s)
         if message.caption:
-            sessions.add_text(user_id, message.caption)
+            sessions.add_text(user_id, message.caption, session=s)
         return
 
     if mode == "bulk_collect":
@@ -295,9 +476,9 @@ async def collect_photo(message: Message):
             "file_id": file_id,
             "kind": "photo",
             "message_id": message.message_id,  # 👈 добавили
-        })
+        }, session=s)
         if message.caption:
-            sessions.bulk_add_text(user_id, message.caption)
+            sessions.bulk_add_text(user_id, message.caption, session=s)
         return
 
 
@@ -346,11 +527,11 @@ async def ready_button(message: Message):
         if not s:
             return
 
-        parsed = dish_parser.parse(s["texts"])
-        sessions.set_parsed(message.from_user.id, parsed)
-        sessions.set_mode(message.from_user.id, "edit")
+        parsed = dish_parser.parse(s.texts or [])
+        sessions.set_parsed(message.from_user.id, parsed, session=s)
+        sessions.set_mode(message.from_user.id, "edit", session=s)
 
-        card = render_dish_card(parsed, photo_count=len(s["photos"]))
+        card = render_dish_card(parsed, photo_count=len(s.photos or []))
         explanation = explain_meta(parsed["_meta"])
 
         await message.answer(
@@ -364,17 +545,18 @@ async def ready_button(message: Message):
 # Inline edit
 # -------------------------
 
-@dp.callback_query(F.data.in_({"edit_name", "edit_composition", "edit_weight", "edit_prices", "edit_ikpu"}))
+_EDIT_KEY_MAP = {
+    "edit_name": ("name", "✏️ Введи новое название:"),
+    "edit_composition": ("composition", "✏️ Введи новый состав/описание:"),
+    "edit_weight": ("weight", "✏️ Введи вес/объем (например: 200 мл) или «—» чтобы очистить:"),
+    "edit_prices": ("prices", "✏️ Введи цены построчно (каждая строка = вес - цена)\nНапр:\n400 г - 60000\n1000 г - 135000\n\nЧтобы очистить — «—»."),
+    "edit_ikpu": ("ikpu", "✏️ Введи ИКПУ или «—» чтобы очистить:"),
+}
+
+
+@dp.callback_query(F.data.in_(set(_EDIT_KEY_MAP)))
 async def edit_field(callback: CallbackQuery):
-    key_map = {
-        "edit_name": ("name", "✏️ Введи новое название:"),
-        "edit_composition": ("composition", "✏️ Введи новый состав/описание:"),
-        "edit_weight": ("weight", "✏️ Введи вес/объем (например: 200 мл) или «—» чтобы очистить:"),
-        "edit_prices": ("prices", "✏️ Введи цены построчно (каждая строка = вес - цена)\nНапр:\n400 г - 60000\n1000 г - 135000\n\nЧтобы очистить — «—»."),
-        "edit_ikpu": ("ikpu", "✏️ Введи ИКПУ или «—» чтобы очистить:"),
-    }
-
-    field, prompt = key_map[callback.data]
+    field, prompt = _EDIT_KEY_MAP[callback.data]
     sessions.set_edit_mode(callback.from_user.id, field)
     await callback.message.answer(prompt)
     await callback.answer()
@@ -392,74 +574,48 @@ async def apply_edit(message: Message, edit_mode: str, parsed: Dict[str, Any]) -
             parsed[edit_mode] = None
     else:
         if edit_mode == "prices":
-            new_prices: List[Dict[str, Any]] = []
-            for line in text.splitlines():
-                if "-" not in line:
-                    continue
-                left, right = line.split("-", 1)
-                price_digits = re.sub(r"\D", "", right)
+            new_prices: List[PriceItem] = []
+            cheapest: Optional[int] = None
+            for m in _PRICE_EDIT_LINE_RE.finditer(text):
+                price_digits = _NON_DIGIT_RE.sub("", m.group(2))
                 if not price_digits:
                     continue
-                new_prices.append({
-                    "weight": left.strip(),
-                    "price": int(price_digits)
-                })
+                price = int(price_digits)
+                new_prices.append(PriceItem(m.group(1), price))
+                if cheapest is None or price < cheapest:
+                    cheapest = price
 
             parsed["prices"] = new_prices
-            parsed["price"] = min(p["price"] for p in new_prices) if new_prices else None
+            parsed["price"] = cheapest
             parsed["weight"] = None
         else:
             parsed[edit_mode] = text
 
-    sessions.set_edit_mode(message.from_user.id, None)
+    sessions.set_edit_mode(message.from_user.id, None, session=s)
 
-    if sessions.get_mode(message.from_user.id) == "bulk_review":
-        sessions.bulk_set_current_parsed(message.from_user.id, parsed)
+    user_id = message.from_user.id
+    mode = sessions.get_mode(user_id, session=s)
+    if mode == "bulk_review":
+        sessions.bulk_set_current_parsed(user_id, parsed, _bulk_caption_base(parsed), session=s)
 
     await message.answer("✅ Обновлено")
 
-    user_id = message.from_user.id
-    mode = sessions.get_mode(user_id)
-
     # ---------- BULK REVIEW ----------
     if mode == "bulk_review":
         pos = sessions.bulk_get_current(user_id)
         if pos and pos.get("photo"):
-            photo_obj = pos["photo"]    
-            reply_to_id = pos.get("photo_message_id")
-            if isinstance(photo_obj, str):
-                photo_obj = {"file_id": photo_obj, "kind": "photo"}
-
-            card = render_dish_card(parsed, photo_count=1)
-            explanation = explain_meta(parsed["_meta"])
-            caption = f"{card}\n\n📌 Как я это понял:\n{explanation}"
-
-            if photo_obj.get("kind") == "document":
-                await bot.send_document(
-                    chat_id=message.chat.id,
-                    document=photo_obj["file_id"],
-                    caption=caption,
-                    reply_markup=edit_keyboard,
-                    reply_to_message_id=reply_to_id,
-                )
-            else:
-                await bot.send_photo(
-                    chat_id=message.chat.id,
-                    photo=photo_obj["file_id"],
-                    caption=caption,
-                    reply_markup=edit_keyboard,
-                    reply_to_message_id=reply_to_id,
-                )
+            caption = pos.get("caption_base") or _bulk_caption_base(parsed)
+            await _send_position_card(message.chat.id, pos["photo"], caption, pos.get("photo_message_id"))
             return
     
     # ---------- MANUAL MODE ----------
-    if s and s.get("photos"):
-        card = render_dish_card(parsed, photo_count=len(s["photos"]))
+    if s and s.photos:
+        card = render_dish_card(parsed, photo_count=len(s.photos or []))
         explanation = explain_meta(parsed["_meta"])
 
         await bot.send_photo(
             chat_id=message.chat.id,
-            photo=s["photos"][0],
+            photo=s.photos[0],
             caption=f"{card}\n\n📌 Как я это понял:\n{explanation}",
             reply_markup=edit_keyboard
             )
@@ -476,21 +632,55 @@ async def apply_edit(message: Message, edit_mode: str, parsed: Dict[str, Any]) -
 
 @dp.message(F.text == "✔️ Меню готово")
 async def menu_ready(message: Message):
-    s = sessions.get_session(message.from_user.id)
-    if not s or not s.get("menu", {}).get("sheet_url"):
+    user_id = message.from_user.id
+    s = sessions.get_session(user_id)
+    if not s or not s.menu or not s.menu.get("sheet_url"):
         await message.answer("Нет привязанной таблицы.", reply_markup=keyboard_start)
         return
 
-    await message.answer("⏳ Выгружаю меню в Google Sheets…")
-    sheet_url = s["menu"]["sheet_url"]
-    rows_items = s["menu"]["rows"]
+    if sessions.get_mode(user_id, session=s) == "menu_export":
+        await message.answer(_EXPORT_IN_PROGRESS)
+        return
 
-    sheets.export_rows(sheet_url, rows_items)
+    await message.answer("⏳ Выгружаю меню в Google Sheets…")
+    sessions.set_mode(user_id, "menu_export", session=s)
+
+    # выгрузка идет фоном — хендлер сразу освобождается, результат пришлем отдельным сообщением
+    task = asyncio.create_task(_export_menu(message.chat.id, user_id, s.menu, s.menu["sheet_url"]))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+async def _export_menu(chat_id: int, user_id: int, menu: Dict[str, Any], sheet_url: str) -> None:
+    # то, что уже ушло в фоновую выгрузку, ждем; остальное (и упавшее) выгружаем здесь.
+    # menu и sheet_url сняты в menu_ready: сессия за время ожидания могла смениться
+    pending = _export_pending.get(user_id)
+    if pending is not None:
+        await pending.idle.wait()
+    failed_items = sessions.take_failed_menu_rows(menu)
+    rows_items = failed_items + sessions.get_unstreamed_menu_rows(menu)
+
+    try:
+        if rows_items:
+            await asyncio.to_thread(sheets.export_rows, sheet_url, rows_items)
+    except Exception as e:
+        print(f"⚠️ Выгрузка меню не удалась (user {user_id}): {e!r}")
+        sessions.add_failed_menu_rows(menu, failed_items)
+        if sessions.get_mode(user_id) == "menu_export":
+            sessions.set_mode(user_id, "manual_menu")
+        await bot.send_message(
+            chat_id,
+            "❌ Не удалось выгрузить меню. Попробуй ещё раз «✔️ Меню готово».",
+            reply_markup=keyboard_manual_menu
+        )
+        return
 
-    sessions.clear_session(message.from_user.id)
-    sessions.ensure_session(message.from_user.id)
+    # пока шла выгрузка, пользователь мог уйти в другой сценарий — его не трогаем
+    if sessions.get_mode(user_id) == "menu_export":
+        sessions.clear_session(user_id)
+        sessions.ensure_session(user_id)
 
-    await message.answer("🎉 Меню успешно выгружено в Google Sheets", reply_markup=keyboard_start)
+    await bot.send_message(chat_id, "🎉 Меню успешно выгружено в Google Sheets", reply_markup=keyboard_start)
 
 
 # -------------------------
@@ -517,13 +707,61 @@ async def bulk_done(message: Message):
         )
         return
 
+    # разбираем все позиции одним проходом, чтобы показ/правки не парсили заново
+    for pos in positions:
+        pos["parsed"] = dish_parser.parse_bulk_position(pos["texts"])
+        pos["caption_base"] = _bulk_caption_base(pos["parsed"])
+
     sessions.stop_bulk(user_id)           # больше не собираем новые элементы
     sessions.set_mode(user_id, "bulk_review")
 
+    # file_path для всех позиций — одним параллельным заходом, а не по одному на каждое «Готово».
+    # Фоном: первую позицию показываем сразу, не дожидаясь getFile (промах кэша get_file_path догрузит)
+    file_ids = {fid for fid in (_position_file_id(pos) for pos in positions) if fid}
+    task = asyncio.create_task(prefetch_file_paths(list(file_ids)))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
     await message.answer("✅ Меню принято. Начинаю проверку позиций…", reply_markup=keyboard_dish_collect)
     await show_bulk_current(message)
 
 
+async def _send_position_card(chat_id: int, photo_obj: Any, caption: str, reply_to_id: Optional[int]) -> None:
+    """
+    Карточка позиции: фото или документ (как прислал пользователь) + edit_keyboard.
+    На 429 ждем retry_after и повторяем.
+    """
+    # старые позиции могли сохраниться как строка (file_id) — подстрахуемся
+    if isinstance(photo_obj, str):
+        photo_obj = {"file_id": photo_obj, "kind": "photo"}
+
+    if photo_obj.get("kind") == "document":
+        send, media_field = bot.send_document, "document"
+    else:
+        send, media_field = bot.send_photo, "photo"
+
+    for attempt in range(_SEND_RETRY_ATTEMPTS):
+        try:
+            await send(
+                chat_id=chat_id,
+                caption=caption,
+                reply_markup=edit_keyboard,
+                reply_to_message_id=reply_to_id,  # 👈 ВАЖНО
+                **{media_field: photo_obj["file_id"]},
+            )
+            return
+        except TelegramRetryAfter as e:
+            if attempt == _SEND_RETRY_ATTEMPTS - 1:
+                raise
+            await asyncio.sleep(e.retry_after)
+
+
+def _bulk_caption_base(parsed: Dict[str, Any]) -> str:
+    card = render_dish_card(parsed, photo_count=1)
+    explanation = explain_meta(parsed["_meta"])
+    return f"{card}\n\n📌 Как я это понял:\n{explanation}"
+
+
 async def show_bulk_current(message: Message) -> None:
     user_id = message.from_user.id
     pos = sessions.bulk_get_current(user_id)
@@ -535,46 +773,22 @@ async def show_bulk_current(message: Message) -> None:
         return
 
     s = sessions.get_session(user_id)
-    idx = (s["bulk"]["current_index"] + 1) if s else 1
-    texts = pos.get("texts", [])
-
-    parsed = dish_parser.parse_bulk_position(texts)
+    idx = (s.bulk.current_index + 1) if s and s.bulk else 1
+
+    # parsed и подпись посчитаны заранее в bulk_done (и пересчитываются в apply_edit)
+    parsed = pos.get("parsed")
+    caption_base = pos.get("caption_base")
+    if parsed is None:
+        parsed = dish_parser.parse_bulk_position(pos.get("texts", []))
+        caption_base = None
+    if caption_base is None:
+        caption_base = _bulk_caption_base(parsed)
     sessions.set_parsed(user_id, parsed)
-    sessions.bulk_set_current_parsed(user_id, parsed)
-
-    card = render_dish_card(parsed, photo_count=1)
-    explanation = explain_meta(parsed["_meta"])
-
-    caption = (
-        f"📋 Проверка позиции {idx} из {total}\n\n"
-        f"{card}\n\n"
-        f"📌 Как я это понял:\n{explanation}"
-    )
-    
+    sessions.bulk_set_current_parsed(user_id, parsed, caption_base)
 
-    photo_obj = pos["photo"]
-    reply_to_id = pos.get("photo_message_id")
-
-    # старые позиции могли сохраниться как строка (file_id) — подстрахуемся
-    if isinstance(photo_obj, str):
-        photo_obj = {"file_id": photo_obj, "kind": "photo"}
+    caption = f"📋 Проверка позиции {idx} из {total}\n\n{caption_base}"
 
-    if photo_obj.get("kind") == "document":
-        await bot.send_document(
-            chat_id=message.chat.id,
-            document=photo_obj["file_id"],
-            caption=caption,
-            reply_markup=edit_keyboard,
-            reply_to_message_id=reply_to_id,  # 👈 ВАЖНО
-        )
-    else:
-        await bot.send_photo(
-            chat_id=message.chat.id,
-            photo=photo_obj["file_id"],
-            caption=caption,
-            reply_markup=edit_keyboard,
-            reply_to_message_id=reply_to_id,  # 👈 ВАЖНО
-        )
+    await _send_position_card(message.chat.id, pos["photo"], caption, pos.get("photo_message_id"))
 
     await message.answer("Нажми «✔️ Готово», чтобы подтвердить и перейти к следующей.", reply_markup=keyboard_dish_collect)
 
@@ -587,94 +801,192 @@ async def bulk_confirm_and_next(message: Message) -> None:
         await message.answer("Нет позиции для подтверждения.", reply_markup=keyboard_start)
         return
 
-    parsed = pos.get("parsed") or s.get("parsed") or {}
+    parsed = pos.get("parsed") or s.parsed or {}
 
     # photo url
     photo_url = None
-    photo_obj = pos.get("photo")
-    file_id = None
-
-    if isinstance(photo_obj, dict):
-        file_id = photo_obj.get("file_id")
-    elif isinstance(photo_obj, str):
-        file_id = photo_obj
+    file_id = _position_file_id(pos)
 
     if file_id:
-        f = await bot.get_file(file_id)
-        photo_url = "https://api.telegram.org/file/bot{token}/{path}".format(token=BOT_TOKEN, path=f.file_path)
+        path = await get_file_path(file_id)
+        photo_url = "https://api.telegram.org/file/bot{token}/{path}".format(token=BOT_TOKEN, path=path)
 
     items = build_sheet_items(parsed, photo_url)
-    sessions.add_menu_rows(user_id, items)
+    sessions.add_menu_rows(user_id, items, session=s)
 
-    sessions.bulk_next(user_id)
+    # выгружаем в таблицу фоном, пока пользователь проверяет следующие позиции
+    sheet_url = s.menu.get("sheet_url") if s.menu else None
+    if _export_queue is not None and sheet_url:
+        sessions.mark_menu_rows_streamed(user_id, len(items), session=s)
+        _pending_add(user_id)
+        await _export_queue.put((user_id, sheet_url, s.menu, items))
+
+    sessions.bulk_next(user_id, session=s)
     await show_bulk_current(message)
 
 
-def build_sheet_items(parsed: Dict[str, Any], photo_url: Optional[str]) -> List[Dict[str, Any]]:
-    items: List[Dict[str, Any]] = []
+async def get_file_path(file_id: str) -> str:
+    entry = _file_path_cache.get(file_id)
+    if entry is not None and time.monotonic() - entry[1] < _FILE_PATH_TTL:
+        _file_path_cache.move_to_end(file_id)
+        return entry[0]
 
-    if parsed.get("prices"):
-        for p in parsed["prices"]:
-            items.append({
-                "Позиция": parsed.get("name"),
-                "Описание": parsed.get("composition"),
-                "Вес": p.get("label") or p.get("weight"),
-                "Цена": p.get("price"),
-                "Код ИКПУ": parsed.get("ikpu"),
-                "Картинка": photo_url,
-            })
-    else:
-        items.append({
-            "Позиция": parsed.get("name"),
-            "Описание": parsed.get("composition"),
-            "Вес": parsed.get("weight"),
-            "Цена": parsed.get("price"),
-            "Код ИКПУ": parsed.get("ikpu"),
-            "Картинка": photo_url,
-        })
+    f = await bot.get_file(file_id)
+    path = f.file_path
+    _file_path_cache[file_id] = (path, time.monotonic())
+    _file_path_cache.move_to_end(file_id)
+    if len(_file_path_cache) > _FILE_PATH_CACHE_MAX:
+        _file_path_cache.popitem(last=False)
+    return path
+
+
+async def prefetch_file_paths(file_ids: List[str]) -> None:
+    """Параллельно прогревает _file_path_cache (ошибки не критичны — при подтверждении запросим заново)."""
+    semaphore = asyncio.Semaphore(_FILE_PREFETCH_CONCURRENCY)
 
-    return items
+    async def fetch(file_id: str) -> None:
+        async with semaphore:
+            await get_file_path(file_id)
+
+    await asyncio.gather(*(fetch(fid) for fid in file_ids), return_exceptions=True)
+
+
+def _position_file_id(pos: Dict[str, Any]) -> Optional[str]:
+    photo_obj = pos.get("photo")
+    if isinstance(photo_obj, dict):
+        return photo_obj.get("file_id")
+    if isinstance(photo_obj, str):
+        return photo_obj
+    return None
+
+
+def _pending_add(user_id: int) -> None:
+    pending = _export_pending.get(user_id)
+    if pending is None:
+        pending = _export_pending[user_id] = _PendingExports()
+    pending.count += 1
+
+
+def _pending_done(user_id: int) -> None:
+    pending = _export_pending[user_id]
+    pending.count -= 1
+    if pending.count == 0:
+        del _export_pending[user_id]
+        pending.idle.set()
+
+
+async def _export_worker() -> None:
+    """
+    Забирает подтвержденные позиции из _export_queue и выгружает их пачками
+    (до _EXPORT_BATCH_ROWS строк, по одному append на лист таблицы).
+    Упавшие строки возвращаются в menu, из которого пришли, — их довыгрузит menu_ready.
+    """
+    # клиент Sheets (разбор ключа сервисного аккаунта, RSA-подписчик) создаем заранее, пока очередь
+    # пуста — первая выгрузка не ждет авторизации. Не вышло — get_client повторит при выгрузке
+    try:
+        await asyncio.to_thread(sheets.get_client)
+    except Exception as e:
+        print(f"⚠️ Клиент Google Sheets не создан заранее: {e!r}")
+
+    while True:
+        jobs = [await _export_queue.get()]
+        rows_count = len(jobs[0][3])
+        while rows_count < _EXPORT_BATCH_ROWS and not _export_queue.empty():
+            job = _export_queue.get_nowait()
+            jobs.append(job)
+            rows_count += len(job[3])
+
+        # группа — одно меню одной таблицы: (user_id, sheet_url, menu, items)
+        grouped: Dict[Tuple[int, str], Tuple[int, str, Dict[str, Any], List[Tuple[Any, ...]]]] = {}
+        for user_id, sheet_url, menu, items in jobs:
+            group = grouped.get((id(menu), sheet_url))
+            if group is None:
+                group = grouped[(id(menu), sheet_url)] = (user_id, sheet_url, menu, [])
+            group[3].extend(items)
+
+        # один вызов на все пачки: строки в один и тот же лист sheets.export_batches сольет в один append
+        groups = list(grouped.values())
+        try:
+            failed = await asyncio.to_thread(sheets.export_batches, [(url, items) for _, url, _, items in groups])
+        except Exception as e:
+            failed = dict.fromkeys(range(len(groups)), e)
+
+        for i, e in failed.items():
+            user_id, _, menu, items = groups[i]
+            print(f"⚠️ Фоновая выгрузка не удалась (user {user_id}): {e!r}")
+            sessions.add_failed_menu_rows(menu, items)
+
+        for job in jobs:
+            _pending_done(job[0])
+            _export_queue.task_done()
+
+
+def build_sheet_items(parsed: Dict[str, Any], photo_url: Optional[str]) -> List[Tuple[Any, ...]]:
+    # строки сразу кортежами в порядке sheets.FIELDS, а не dict на строку: меньше памяти
+    # в сессии/очереди, и выгрузке не нужно собирать строку по ключам
+    name = parsed.get("name")
+    composition = parsed.get("composition")
+    ikpu = parsed.get("ikpu")
+
+    if parsed.get("prices"):
+        return [(name, composition, p.price, p.weight, ikpu, photo_url) for p in parsed["prices"]]
+    return [(name, composition, parsed.get("price"), parsed.get("weight"), ikpu, photo_url)]
 
 
 # -------------------------
 # Text collector + edit apply
 # -------------------------
 
+# кнопки, которые collect_text не должен складывать в тексты
+_BULK_COMMANDS = frozenset({"✅ Меню загружено", "🏠 Главное меню"})
+_DISH_COMMANDS = frozenset({"✔️ Готово", "❌ Отменить"})
+
+
 @dp.message(F.text)
 async def collect_text(message: Message):
     user_id = message.from_user.id
-    sessions.ensure_session(user_id)  # ✅ добавь
+    s = sessions.ensure_session(user_id)  # ✅ добавь
 
-    mode = sessions.get_mode(user_id)
+    mode = sessions.get_mode(user_id, session=s)
     text = (message.text or "").strip()
     if not text:
         return
 
     if mode == "bulk_collect":
-        if text in ("✅ Меню загружено", "🏠 Главное меню"):
+        if text in _BULK_COMMANDS:
             return
-        sessions.bulk_add_text(user_id, text)
+        sessions.bulk_add_text(user_id, text, session=s)
         return
 
     if mode == "dish_collect":
-        if text in ("✔️ Готово", "❌ Отменить"):
+        if text in _DISH_COMMANDS:
             return
-        sessions.add_text(user_id, text)
-        return
-
-    s = sessions.get_session(user_id)
-    if not s:
+        sessions.add_text(user_id, text, session=s)
         return
 
-    edit_mode = s.get("edit_mode")
-    parsed = s.get("parsed")
+    edit_mode = s.edit_mode
+    parsed = s.parsed
     if edit_mode and parsed:
         await apply_edit(message, edit_mode, parsed)
         return
 
 async def main():
+    global _export_queue
+    _export_queue = asyncio.Queue()
+    export_task = asyncio.create_task(_export_worker())
+
     print("🤖 Bot started")
-    await dp.start_polling(bot)
+    try:
+        # long polling 30 с: меньше пустых getUpdates; апдейты обрабатываются задачами
+        # (порядок внутри чата держит PerUserQueueMiddleware); берем только нужные типы апдейтов
+        await dp.start_polling(
+            bot,
+            polling_timeout=30,
+            handle_as_tasks=True,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+    finally:
+        export_task.cancel()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
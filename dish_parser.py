@@ -13,13 +13,22 @@ dish_parser.py
 """
 
 import re
-from typing import List, Dict, Any, Tuple, Optional
+from typing import List, Dict, Any, Final, FrozenSet, Iterator, NamedTuple, Tuple, Optional
+
+# -----------------------------
+# Типы
+# -----------------------------
+class PriceItem(NamedTuple):
+    """Вариант цены: weight — вес/объем/любая подпись варианта ("30 см", "1 шт")."""
+    weight: str
+    price: int
+
 
 # -----------------------------
 # Ключевые слова / алиасы
 # -----------------------------
 # Важно: тут специально много вариантов (RU + латиница + типичные опечатки для Узбекистана)
-KEY_ALIASES: Dict[str, Tuple[str, ...]] = {
+KEY_ALIASES: Final[Dict[str, Tuple[str, ...]]] = {
     "name": (
         "наименование", "название", "имя", "товар", "позиция",
         "nomi", "nom", "name", "title", "naming",
@@ -50,43 +59,85 @@ KEY_ALIASES: Dict[str, Tuple[str, ...]] = {
 }
 
 # Эти ключи используются как стоп-слова при сборе многострочного блока
-STOP_KEYS = tuple(sorted({k for vs in KEY_ALIASES.values() for k in vs}))
+STOP_KEYS: Final = tuple(sorted({k for vs in KEY_ALIASES.values() for k in vs}))
+
+_ALL_ALIASES: Final[FrozenSet[str]] = frozenset(STOP_KEYS)
+
+# алиас -> канонический ключ (при повторе алиаса выигрывает первый канон, как в переборе KEY_ALIASES)
+_ALIAS_TO_CANON: Final[Dict[str, str]] = {}
+for _canon, _aliases in KEY_ALIASES.items():
+    for _a in _aliases:
+        _ALIAS_TO_CANON.setdefault(_a, _canon)
+del _canon, _aliases, _a
 
 # -----------------------------
 # Регулярки
 # -----------------------------
-_UNITS = r"(г|гр|g|gr|kg|кг|mg|мг|ml|мл|l|л|oz|шт|pcs|pc|piece|pieces|dona|ta)"
-_WEIGHT_RE = re.compile(r"\b\d+(?:[.,]\d+)?\s*" + _UNITS + r"\b", re.IGNORECASE)
-_WEIGHT_ATTR_RE = re.compile(
+_UNITS: Final = r"(г|гр|g|gr|kg|кг|mg|мг|ml|мл|l|л|oz|шт|pcs|pc|piece|pieces|dona|ta)"
+_WEIGHT_RE: Final = re.compile(r"\b\d+(?:[.,]\d+)?\s*" + _UNITS + r"\b", re.IGNORECASE)
+_WEIGHT_ATTR_RE: Final = re.compile(
     r"(?i)\b(?:вес|вес\s*нетто|нетто|weight|massa|mass)\b\s*[:\-]?\s*(\d+(?:[.,]\d+)?(?:\s*[a-zа-яё\.]{0,6})?)"
 )
 # цена: строка из цифр/пробелов/точек/запятых (не слишком длинная)
-_PRICE_LINE_RE = re.compile(r"^\s*\d[\d\s.,]{1,}\d\s*(?:сум|sum|som|so'm|uzs)?\s*$", re.IGNORECASE)
+_PRICE_LINE_RE: Final = re.compile(r"^\s*\d[\d\s.,]{1,}\d\s*(?:сум|sum|som|so'm|uzs)?\s*$", re.IGNORECASE)
+
+# число-кандидат в цену внутри свободного текста
+_PRICE_FRAGMENT_RE: Final = re.compile(r"\d[\d\s.,]{2,}\d")
 
 # ИКПУ — 17 цифр
-_IKPU_LINE_RE = re.compile(r"^\s*\d{17}\s*$")
-_IKPU_ANY_RE = re.compile(r"\b\d{17}\b")
+_IKPU_LINE_RE: Final = re.compile(r"^\s*\d{17}\s*$")
+_IKPU_ANY_RE: Final = re.compile(r"\b\d{17}\b")
 
 # универсальная пара "вариант — цена" (вариант = вес/начинка/размер/что угодно)
-_PAIR_RE = re.compile(
+_PAIR_RE: Final = re.compile(
     r"^(?P<label>.+?)\s*[—\-–]\s*(?P<price>\d[\d\s.,]*\d)\s*$",
     re.IGNORECASE
 )
 
 # "ключ:" или "ключ -" или "ключ —"
-_LABELED_RE = re.compile(
+_LABELED_RE: Final = re.compile(
     r"^\s*(?P<key>[^\n\r:—\-–]{2,40}?)\s*[:—\-–]\s*(?P<value>.+?)\s*$",
     re.IGNORECASE
 )
 
 # "ключ значение" (без двоеточия) — только для известных коротких ключей
-_LABELED_SPACE_RE = re.compile(
+_LABELED_SPACE_RE: Final = re.compile(
     r"^\s*(?P<key>[^\n\r:—\-–]{2,40}?)\s+(?P<value>.+?)\s*$",
     re.IGNORECASE
 )
 
 # Калорийность/прочие хвосты, на которых стоит остановить состав
-_COMPOSITION_STOP_RE = re.compile(r"\b(ккал|калл|кал|kcal|cal)\b", re.IGNORECASE)
+_COMPOSITION_STOP_RE: Final = re.compile(r"\b(ккал|калл|кал|kcal|cal)\b", re.IGNORECASE)
+
+# разделители "ключ: значение" / "вариант — цена"
+_SEP_CHARS: Final = frozenset(":—-–")
+
+_DIGIT_RE: Final = re.compile(r"\d")
+_NON_DIGIT_RE: Final = re.compile(r"\D")
+_NUMBER_RE: Final = re.compile(r"\b\d+(?:[.,]\d+)?\b")
+_WS_RE: Final = re.compile(r"\s+")
+
+# "ключ:" / "ключ -" / "ключ —" для любого стоп-ключа — одна альтернация вместо прохода по STOP_KEYS
+# (порядок алиасов на результат не влияет — при неудаче движок перебирает остальные варианты)
+_ANY_STOP_LABELED_RE: Final = re.compile(
+    r"^\s*(?:" + "|".join(re.escape(k) for k in sorted(STOP_KEYS, key=len, reverse=True)) + r")\s*[:—\-–]",
+    re.IGNORECASE
+)
+
+# стоп-ключ отдельным словом где угодно в строке (а не подстрокой: "вес" в "весенний" не в счет)
+_ANY_STOP_WORD_RE: Final = re.compile(
+    r"\b(?:" + "|".join(re.escape(k) for k in sorted(STOP_KEYS, key=len, reverse=True)) + r")\b",
+    re.IGNORECASE
+)
+
+# длиннее этого строка не может совпасть с заголовком "состав" — lower() для нее не нужен
+_COMP_ALIAS_MAX_LEN: Final = max(len(a) for a in KEY_ALIASES["composition"])
+
+# заголовок блока "ключ:" — canon -> ((алиас, паттерн), ...)
+_HEADER_COLON_RES: Final[Dict[str, Tuple[Tuple[str, "re.Pattern[str]"], ...]]] = {
+    canon: tuple((a, re.compile(r"^\s*" + re.escape(a) + r"\s*:\s*", re.IGNORECASE)) for a in aliases)
+    for canon, aliases in KEY_ALIASES.items()
+}
 
 
 # -----------------------------
@@ -94,29 +145,67 @@ _COMPOSITION_STOP_RE = re.compile(r"\b(ккал|калл|кал|kcal|cal)\b", re
 # -----------------------------
 def _canon_key(raw: str) -> Optional[str]:
     """Пытаемся сопоставить сырое имя ключа каноническому."""
-    k = raw.strip().lower()
-    k = re.sub(r"\s+", " ", k)
-    for canon, aliases in KEY_ALIASES.items():
-        for a in aliases:
-            if k == a:
-                return canon
-    return None
+    k = _WS_RE.sub(" ", raw.strip().lower())
+    return _ALIAS_TO_CANON.get(k)
 
 
-def normalize_texts(texts: List[str]) -> List[str]:
-    lines: List[str] = []
+class Line(NamedTuple):
+    """
+    Строка сообщения, разобранная один раз: построчные регулярки считаются при чтении,
+    а проходы парсера смотрят уже на готовые признаки.
+    """
+    line: str
+    ikpu: Optional[str]                 # 17 цифр в строке
+    pair: Optional["re.Match[str]"]     # "вариант — цена"
+    price_line: bool                    # строка-цена
+    weight: Optional["re.Match[str]"]   # вес/объем в строке
+    calories: bool                      # калорийность — конец состава
+    key_stop: bool                      # начало другого атрибута ("цена: ...", "цена 9000")
+    has_sep: bool                       # есть ли ":", "—", "-", "–"
+    has_digit: bool                     # есть ли цифры
+
+
+def _classify_line(line: str) -> Line:
+    # без разделителя не сработают ни "ключ: значение", ни пара "вариант — цена",
+    # а без цифр — ни ИКПУ, ни цена, ни вес: обычные строки состава ("лук", "морковь")
+    # эти регулярки не запускают
+    has_sep = not _SEP_CHARS.isdisjoint(line)
+    has_digit = _DIGIT_RE.search(line) is not None
+    m_ikpu = _IKPU_ANY_RE.search(line) if has_digit else None
+    return Line(
+        line,
+        m_ikpu.group(0) if m_ikpu else None,
+        _PAIR_RE.match(line) if has_sep and has_digit else None,
+        has_digit and _PRICE_LINE_RE.match(line) is not None,
+        _WEIGHT_RE.search(line) if has_digit else None,
+        _COMPOSITION_STOP_RE.search(line) is not None,
+        (has_sep and _ANY_STOP_LABELED_RE.match(line) is not None)
+        or (line.strip().split(" ", 1)[0].lower() in _ALL_ALIASES and len(line.split()) >= 2),
+        has_sep,
+        has_digit,
+    )
+
+
+def _iter_lines(texts: List[str]) -> Iterator[str]:
     for text in texts:
         if not text:
             continue
         for line in str(text).splitlines():
             line = line.strip()
             if line:
-                lines.append(line)
-    return lines
+                yield line
+
+
+def _as_lines(lines: List[str]) -> List[Line]:
+    return [_classify_line(line) for line in lines]
+
+
+def normalize_texts(texts: List[str]) -> List[str]:
+    return list(_iter_lines(texts))
 
 
 def _digits_to_int(s: str) -> Optional[int]:
-    digits = re.sub(r"\D", "", s or "")
+    digits = _NON_DIGIT_RE.sub("", s or "")
     if 3 <= len(digits) <= 9:
         try:
             return int(digits)
@@ -145,67 +234,150 @@ def _normalize_weight_value(raw: str) -> Optional[str]:
         return m.group(0).strip()
 
     # если единиц нет — возьмем число и по умолчанию считаем граммами
-    m2 = re.search(r"\b\d+(?:[.,]\d+)?\b", raw)
+    m2 = _NUMBER_RE.search(raw)
     if m2:
         val = m2.group(0)
         return f"{val} г"
 
     return None
 
-def _extract_labeled_fields(lines: List[str]) -> Tuple[Dict[str, str], List[str]]:
+def _match_labeled(line: str, has_sep: bool) -> Optional[Tuple[str, Optional[str]]]:
     """
-    Достает пары ключ->значение из строк.
+    Пробует прочитать строку как пару ключ->значение.
 
     Поддерживает:
     - "ключ: значение"
     - "ключ - значение"
     - "ключ значение" (для коротких ключей типа "цена 9000", "икпу 1020...", "вес 120гр")
-    - "Состав" / "Состав:" как заголовок без значения — заголовок вынимаем, а состав оставляем
-      для дальнейшего чтения блоком.
+    - "Состав" / "Состав:" как заголовок без значения — возвращаем (canon, None): строку
+      из remaining вынимаем, а состав оставляем для дальнейшего чтения блоком.
+
+    None — строка не атрибут.
     """
-    labeled: Dict[str, str] = {}
-    remaining: List[str] = []
+    # 1) ключ: значение / ключ - значение
+    m = _LABELED_RE.match(line) if has_sep else None
+    if m:
+        raw_key = m.group("key")
+        value = m.group("value").strip()
+        canon = _canon_key(raw_key)
+        if canon:
+            # особый случай: "состав:" может начинаться блоком и продолжаться ниже
+            if canon == "composition" and not value:
+                return canon, None
+            return canon, value
+
+    # 2) ключ значение (без двоеточия) — только если первый токен = известный алиас
+    # Пример: "цена 9.000" / "икпу 10202003001000000" / "категория гарнир"
+    # Важно: это может быть и "состав" без ":" — тогда это заголовок состава.
+    parts = line.split()
+    if parts:
+        # регистр приводим только у первого токена, а не у всей строки
+        first = parts[0].lower()
+        if first in _ALL_ALIASES:
+            # first без пробелов — нормализация _canon_key не нужна
+            canon = _ALIAS_TO_CANON.get(first)
+            if canon:
+                if canon == "composition" and len(parts) == 1:
+                    # "состав" как заголовок
+                    return canon, None
+                if len(parts) >= 2:
+                    return canon, line[len(parts[0]):].strip()
 
-    # заранее — множество всех алиасов (для быстрого сравнения)
-    all_aliases = {a for vs in KEY_ALIASES.values() for a in vs}
+    return None
 
-    for line in lines:
-        low = line.strip().lower()
 
-        # 1) ключ: значение / ключ - значение
-        m = _LABELED_RE.match(line)
-        if m:
-            raw_key = m.group("key")
-            value = m.group("value").strip()
-            canon = _canon_key(raw_key)
-            if canon:
-                # особый случай: "состав:" может начинаться блоком и продолжаться ниже
-                if canon == "composition" and not value:
-                    # заголовок состава — убираем строку из remaining, но ничего не кладем
-                    continue
-                labeled[canon] = value
-                continue
+def _header_rest(ln: Line, header_patterns: Tuple[Tuple[str, "re.Pattern[str]"], ...]) -> Optional[str]:
+    """
+    Заголовок блока: "состав:" / "состав :" / "состав" (в одиночку).
+    Возвращает текст после двоеточия ("" если его нет) или None, если это не заголовок.
+    """
+    text = ln.line.strip()
+    for a, header_re in header_patterns:
+        if header_re.match(ln.line):
+            return ln.line.partition(":")[2].strip()
+        if len(text) == len(a) and text.lower() == a:
+            return ""
+    return None
+
+
+class ClassifiedLines(NamedTuple):
+    """Все, что парсеру нужно от строк сообщения, — за один проход."""
+    lines: List[Line]
+    labeled: Dict[str, str]
+    remaining: List[Line]               # строки, не ставшие атрибутами
+    composition_block: List[Line]       # блок после "Состав" / "Состав:"
+    has_composition_header: bool        # "состав" отдельной строкой
+    ikpu: Optional[str]                 # первое ИКПУ в тексте
+    pairs: List["re.Match[str]"]        # пары "вариант — цена" по порядку
+    name_candidate: Optional[str]       # первая строка, похожая на название
 
-        # 2) ключ значение (без двоеточия) — только если первый токен = известный алиас
-        # Пример: "цена 9.000" / "икпу 10202003001000000" / "категория гарнир"
-        # Важно: это может быть и "состав" без ":" — тогда это заголовок состава.
-        parts = low.split()
-        if parts:
-            first = parts[0]
-            if first in all_aliases:
-                canon = _canon_key(first)
-                if canon:
-                    if canon == "composition" and len(parts) == 1:
-                        # "состав" как заголовок
-                        continue
-                    if len(parts) >= 2:
-                        value = line.strip()[len(parts[0]):].strip()
-                        labeled[canon] = value
-                        continue
 
-        remaining.append(line)
+def _classify_lines(texts: List[str]) -> ClassifiedLines:
+    """
+    Один проход по строкам вместо отдельных циклов на атрибуты, детект структуры,
+    блок состава, ИКПУ, пары и название.
+    """
+    lines: List[Line] = []
+    labeled: Dict[str, str] = {}
+    remaining: List[Line] = []
+    block: List[Line] = []
+    pairs: List["re.Match[str]"] = []
+    has_header = False
+    ikpu: Optional[str] = None
+    name_candidate: Optional[str] = None
+
+    comp_aliases = KEY_ALIASES["composition"]
+    header_patterns = _HEADER_COLON_RES["composition"]
+    collecting = False
+    block_done = False
+
+    for line in _iter_lines(texts):
+        ln = _classify_line(line)
+        lines.append(ln)
+
+        if ln.ikpu and ikpu is None:
+            ikpu = ln.ikpu
+        if ln.pair:
+            pairs.append(ln.pair)
+
+        is_comp_header = len(line) <= _COMP_ALIAS_MAX_LEN and line.lower() in comp_aliases
+        if is_comp_header:
+            has_header = True
+
+        # --- атрибуты ---
+        hit = _match_labeled(line, ln.has_sep)
+        if hit is None:
+            remaining.append(ln)
+        elif hit[1] is not None:
+            labeled[hit[0]] = hit[1]
+
+        # --- название: не заголовок "состав", не икпу / цена / пара; цифры допустимы, если это вес ---
+        if (
+            name_candidate is None
+            and not is_comp_header
+            and not ln.ikpu
+            and not ln.price_line
+            and not ln.pair
+            and not (any(ch.isdigit() for ch in line) and not ln.weight)
+        ):
+            name_candidate = line
+
+        # --- блок состава: до следующего ключа ---
+        if not block_done:
+            rest = _header_rest(ln, header_patterns)
+            if rest is not None:
+                collecting = True
+                if rest:
+                    block.append(_classify_line(rest))
+            elif collecting:
+                if ln.key_stop:
+                    block_done = True
+                else:
+                    block.append(ln)
 
-    return labeled, remaining
+    return ClassifiedLines(
+        lines, labeled, remaining, block, has_header, ikpu, pairs, name_candidate
+    )
 
 
 def collect_block(lines: List[str], header_key: str) -> List[str]:
@@ -213,44 +385,32 @@ def collect_block(lines: List[str], header_key: str) -> List[str]:
     Собирает многострочный блок после строки 'Ключ' или 'Ключ:' до следующего ключа.
     Устойчиво к 'Ключ' / 'Ключ:' / 'Ключ :'
     """
-    result: List[str] = []
+    return [ln.line for ln in _collect_block(_as_lines(lines), header_key)]
+
+
+def _collect_block(lines: List[Line], header_key: str) -> List[Line]:
+    result: List[Line] = []
     collecting = False
 
-    # алиасы для заголовка
+    # алиасы для заголовка (для неизвестного ключа — сам ключ)
     header_key = header_key.strip().lower()
-    header_aliases = KEY_ALIASES.get(header_key, (header_key,))
-
-    for line in lines:
-        low = line.lower().strip()
-
-        # старт блока:
-        # - "состав:" или "состав :"
-        # - "состав" (в одиночку)
-        is_header = False
-        for a in header_aliases:
-            if re.match(r"^\s*{0}\s*:\s*".format(re.escape(a)), low):
-                is_header = True
-                collecting = True
-                rest = line.split(":", 1)[1].strip()
-                if rest:
-                    result.append(rest)
-                break
-            if low == a:
-                is_header = True
-                collecting = True
-                break
-
-        if is_header:
+    header_patterns = _HEADER_COLON_RES.get(header_key)
+    if header_patterns is None:
+        header_patterns = ((header_key, re.compile(r"^\s*" + re.escape(header_key) + r"\s*:\s*", re.IGNORECASE)),)
+
+    for ln in lines:
+        rest = _header_rest(ln, header_patterns)
+        if rest is not None:
+            collecting = True
+            if rest:
+                result.append(_classify_line(rest))
             continue
 
         if collecting:
             # стоп по любому другому ключу
-            if any(re.match(r"^\s*{0}\s*[:—\-–]".format(re.escape(k)), low) for k in STOP_KEYS):
-                break
-            if low.split(" ", 1)[0] in STOP_KEYS and len(low.split()) >= 2:
-                # "цена 9000", "категория гарнир"
+            if ln.key_stop:
                 break
-            result.append(line)
+            result.append(ln)
 
     return result
 
@@ -265,33 +425,24 @@ def extract_composition_from_lines(
     - поддерживает состав в столбик
     - останавливается на цене / ИКПУ / других атрибутах / калорийности
     """
-    ingredients: List[str] = []
+    return _extract_composition(_as_lines(lines), stop_on_keys=stop_on_keys)
 
-    for line in lines:
-        low = line.lower().strip()
-        if not low:
-            continue
 
+def _extract_composition(lines: List[Line], *, stop_on_keys: bool = True) -> Optional[str]:
+    ingredients: List[str] = []
+
+    for ln in lines:
         # стоп-условия
-        if _IKPU_ANY_RE.search(line):
-            break
-        if _PAIR_RE.match(line):
-            break
-        if _PRICE_LINE_RE.match(line):
-            break
-        if _COMPOSITION_STOP_RE.search(line):
+        if ln.ikpu or ln.pair or ln.price_line or ln.calories:
             break
 
-        if stop_on_keys:
-            # если встречаем начало другого атрибута — заканчиваем
-            if any(re.match(r"^\s*{0}\s*[:—\-–]".format(re.escape(k)), low) for k in STOP_KEYS):
-                break
-            if low.split(" ", 1)[0] in STOP_KEYS and len(low.split()) >= 2:
-                break
+        # если встречаем начало другого атрибута — заканчиваем
+        if stop_on_keys and ln.key_stop:
+            break
 
         # берем только строки с буквами
-        if any(ch.isalpha() for ch in line):
-            ingredients.append(line.strip())
+        if any(ch.isalpha() for ch in ln.line):
+            ingredients.append(ln.line.strip())
 
     if ingredients:
         # если прислали в столбик — превращаем в список через запятую
@@ -300,7 +451,7 @@ def extract_composition_from_lines(
     return None
 
 
-def _detect_structured(labeled: Dict[str, str], lines: List[str]) -> bool:
+def _detect_structured(labeled: Dict[str, str], has_composition_header: bool) -> bool:
     """
     Авто-детект "структурированного" сообщения.
     Идея: если в тексте явно присутствуют атрибуты — используем labeled/blocks,
@@ -314,11 +465,7 @@ def _detect_structured(labeled: Dict[str, str], lines: List[str]) -> bool:
             return True
 
     # "состав" заголовком (без двоеточия) тоже считаем структурой
-    low_lines = [l.lower().strip() for l in lines]
-    if any(l in KEY_ALIASES["composition"] for l in low_lines):
-        return True
-
-    return False
+    return has_composition_header
 
 
 # -----------------------------
@@ -334,7 +481,7 @@ def parse(texts: List[str]) -> Dict[str, Any]:
         "composition": None,
         "weight": None,     # если вес один
         "price": None,      # минимальная цена
-        "prices": [],       # [{weight, price}]
+        "prices": [],       # [PriceItem(weight, price)]
         "ikpu": None,
         "_meta": {
             "weight_source": None,
@@ -345,33 +492,28 @@ def parse(texts: List[str]) -> Dict[str, Any]:
             }
     }
 
-    lines = normalize_texts(texts)
-    if not lines:
+    cl = _classify_lines(texts)
+    if not cl.lines:
         return result
+    text_lines = cl.lines
 
-    labeled, remaining_lines = _extract_labeled_fields(lines)
-    structured = _detect_structured(labeled, lines)
+    labeled, remaining_pairs = cl.labeled, cl.remaining
+    structured = _detect_structured(labeled, cl.has_composition_header)
     result["_meta"]["structured_detected"] = structured
 
-    full_text = "\n".join(lines).lower()
-
     # --- IKPU (17 цифр в любом месте) ---
-    m_any = _IKPU_ANY_RE.search("\n".join(lines))
-    if m_any:
-        result["ikpu"] = m_any.group(0)
+    if cl.ikpu:
+        result["ikpu"] = cl.ikpu
         result["_meta"]["ikpu_source"] = "detected_anywhere"
 
     # --- MULTI PRICE (вариант — цена) ---
-    for line in lines:
-        m = _PAIR_RE.match(line)
-        if not m:
-            continue
+    for m in cl.pairs:
         price_val = _digits_to_int(m.group("price"))
         if price_val is not None:
-            result["prices"].append({"weight": m.group("label").strip(), "price": price_val})
+            result["prices"].append(PriceItem(m.group("label").strip(), price_val))
 
     if result["prices"]:
-        result["price"] = min(p["price"] for p in result["prices"])
+        result["price"] = min(p.price for p in result["prices"])
         result["weight"] = None
         result["_meta"]["price_source"] = "multi_price_pairs"
 
@@ -393,35 +535,16 @@ def parse(texts: List[str]) -> Dict[str, Any]:
     if "name" in labeled and labeled["name"]:
         result["name"] = labeled["name"].strip()
     else:
-        for line in lines:
-            low = line.lower().strip()
-            if not low:
-                continue
-
-            # не берем заголовок "состав"
-            if low in KEY_ALIASES["composition"]:
-                continue
-
-            # не берем икпу / цену / пары
-            if _IKPU_ANY_RE.search(line):
-                continue
-            if _PRICE_LINE_RE.match(line):
-                continue
-            if _PAIR_RE.match(line):
-                continue
-
-            # цифры допустимы, если это вес
-            if any(char.isdigit() for char in low) and not _WEIGHT_RE.search(line):
-                continue
-
-            result["name"] = line.strip()
-            break
+        # первая "человеческая" строка: не заголовок "состав", не икпу / цена / пара,
+        # цифры допустимы, если это вес
+        if cl.name_candidate:
+            result["name"] = cl.name_candidate
 
     # --- состав ---
     # 1) если есть "Состав/Таркиб" блоком — читаем блок
-    comp_block = collect_block(lines, "composition")
+    comp_block = cl.composition_block
     if comp_block:
-        comp = extract_composition_from_lines(comp_block)
+        comp = _extract_composition(comp_block)
         if comp:
             result["composition"] = comp
             result["_meta"]["composition_source"] = "composition_block"
@@ -440,29 +563,22 @@ def parse(texts: List[str]) -> Dict[str, Any]:
 
     # 4) fallback состава (со всего текста)
     if not result["composition"]:
-        comp = extract_composition_from_lines(remaining_lines if structured else lines)
+        comp = _extract_composition(remaining_pairs if structured else text_lines)
         if comp:
             result["composition"] = comp
             result["_meta"]["composition_source"] = "fallback_from_text"
         else:
             # старый fallback: возьмем самую длинную "буквенную" строку, которая не похожа на цену/вес/икпу
             candidates: List[str] = []
-            for line in (remaining_lines if structured else lines):
-                low = line.lower()
-                if line == result["name"]:
-                    continue
-                if _IKPU_ANY_RE.search(line):
+            for ln in (remaining_pairs if structured else text_lines):
+                if ln.line == result["name"]:
                     continue
-                if _PAIR_RE.match(line):
+                if ln.ikpu or ln.pair or ln.price_line or ln.weight:
                     continue
-                if _PRICE_LINE_RE.match(line):
+                if _ANY_STOP_WORD_RE.search(ln.line):
                     continue
-                if _WEIGHT_RE.search(line):
-                    continue
-                if any(k in low for k in STOP_KEYS):
-                    continue
-                if any(ch.isalpha() for ch in line):
-                    candidates.append(line)
+                if any(ch.isalpha() for ch in ln.line):
+                    candidates.append(ln.line)
             if candidates:
                 candidates.sort(key=len, reverse=True)
                 result["composition"] = candidates[0].strip()
@@ -474,25 +590,26 @@ def parse(texts: List[str]) -> Dict[str, Any]:
     if not result["prices"] and not result["price"]:
         # один вес
         if not result["weight"]:
-            mw = _WEIGHT_RE.search(full_text)
-            if mw:
-                result["weight"] = mw.group(0).strip()
-                result["_meta"]["weight_source"] = "fallback_from_text"
+            for ln in text_lines:
+                if ln.weight:
+                    result["weight"] = ln.weight.group(0).strip().lower()
+                    result["_meta"]["weight_source"] = "fallback_from_text"
+                    break
 
         # одна цена
         candidates_int: List[int] = []
-        for line in lines:
-            l = line.lower().strip()
-            if _IKPU_ANY_RE.search(l):
-                continue
-            if _WEIGHT_RE.search(l):
+        for ln in text_lines:
+            if ln.ikpu or ln.weight:
                 continue
-            if _PRICE_LINE_RE.match(l):
-                pv = _digits_to_int(l)
+            # регистр тут не нужен: ИКПУ/цена — цифры, а вес и строка-цена уже IGNORECASE
+            if ln.price_line:
+                pv = _digits_to_int(ln.line)
                 if pv is not None:
                     candidates_int.append(pv)
                 continue
-            for p in re.findall(r"\d[\d\s.,]{2,}\d", l):
+            if not ln.has_digit:
+                continue
+            for p in _PRICE_FRAGMENT_RE.findall(ln.line):
                 pv = _digits_to_int(p)
                 if pv is not None:
                     candidates_int.append(pv)
@@ -554,33 +671,30 @@ def parse_bulk_position(texts: List[str]) -> Dict[str, Any]:
             }
     }
 
-    lines = normalize_texts(texts)
-    if not lines:
+    cl = _classify_lines(texts)
+    if not cl.lines:
         return parsed
+    text_lines = cl.lines
 
-    labeled, remaining_lines = _extract_labeled_fields(lines)
-    structured = _detect_structured(labeled, lines)
+    labeled, remaining_pairs = cl.labeled, cl.remaining
+    structured = _detect_structured(labeled, cl.has_composition_header)
     parsed["_meta"]["structured_detected"] = structured
 
     # ---------- IKPU (17 цифр в любом месте) ----------
-    m_any = _IKPU_ANY_RE.search("\n".join(lines))
-    if m_any:
-        parsed["ikpu"] = m_any.group(0)
+    if cl.ikpu:
+        parsed["ikpu"] = cl.ikpu
         parsed["_meta"]["ikpu_source"] = "explicit_key"
 
     # ---------- MULTI PRICE (ЛЮБОЙ АТРИБУТ — ЦЕНА) ----------
-    for line in lines:
-        m = _PAIR_RE.match(line)
-        if not m:
-            continue
+    for m in cl.pairs:
         pv = _digits_to_int(m.group("price"))
         if pv is not None:
-            parsed["prices"].append({"weight": m.group("label").strip(), "price": pv})
+            parsed["prices"].append(PriceItem(m.group("label").strip(), pv))
         if parsed["prices"]:
             parsed["_meta"]["price_source"] = "multi_price_pairs"
 
     if parsed["prices"]:
-        parsed["price"] = min(p["price"] for p in parsed["prices"])
+        parsed["price"] = min(p.price for p in parsed["prices"])
         parsed["weight"] = None
         parsed["_meta"]["price_source"] = "multi_price_pairs"
     else:
@@ -593,11 +707,11 @@ def parse_bulk_position(texts: List[str]) -> Dict[str, Any]:
 
         if not parsed["price"]:
             # ищем строку-прайс
-            for line in lines:
-                if _IKPU_ANY_RE.search(line):
+            for ln in text_lines:
+                if ln.ikpu:
                     continue
-                if _PRICE_LINE_RE.match(line):
-                    pv = _digits_to_int(line)
+                if ln.price_line:
+                    pv = _digits_to_int(ln.line)
                     if pv is not None:
                         parsed["price"] = pv
                         parsed["_meta"]["price_source"] = "fallback_from_text"
@@ -607,8 +721,8 @@ def parse_bulk_position(texts: List[str]) -> Dict[str, Any]:
     weight_key_present = False
 
     # 1. Сначала ищем явный атрибут веса в тексте
-    for line in lines:
-        m = _WEIGHT_ATTR_RE.search(line)
+    for ln in text_lines:
+        m = _WEIGHT_ATTR_RE.search(ln.line)
         if m:
             weight_key_present = True
             w = _normalize_weight_value(m.group(1))
@@ -627,10 +741,10 @@ def parse_bulk_position(texts: List[str]) -> Dict[str, Any]:
 
     # 3. И ТОЛЬКО если явного веса НЕ БЫЛО — подхватываем из текста (0.25л и т.п.)
     if not parsed["weight"] and not weight_key_present:
-        for line in lines:
-            if _IKPU_ANY_RE.search(line):
+        for ln in text_lines:
+            if ln.ikpu:
                 continue
-            mw = _WEIGHT_RE.search(line)
+            mw = ln.weight
             if mw:
                 parsed["weight"] = mw.group(0).strip()
                 parsed["_meta"]["weight_source"] = "fallback_from_text"
@@ -640,36 +754,15 @@ def parse_bulk_position(texts: List[str]) -> Dict[str, Any]:
     if "name" in labeled and labeled["name"]:
         parsed["name"] = labeled["name"].strip()
     else:
-        # если первое "человеческое" без цифр — считаем названием
-        for line in lines:
-            low = line.lower().strip()
-            if not low:
-                continue
-
-            # не берем заголовок "состав"
-            if low in KEY_ALIASES["composition"]:
-                continue
-
-            # не берем цену / икпу / пары
-            if _IKPU_ANY_RE.search(line):
-                continue
-            if _PRICE_LINE_RE.match(line):
-                continue
-            if _PAIR_RE.match(line):
-                continue
-
-            # ВАЖНО: цифры допустимы, ЕСЛИ это вес
-            if any(char.isdigit() for char in low) and not _WEIGHT_RE.search(line):
-                continue
-
-            parsed["name"] = line.strip()
-            break
+        # если первое "человеческое" без цифр — считаем названием (цифры допустимы, если это вес)
+        if cl.name_candidate:
+            parsed["name"] = cl.name_candidate
 
     # ---------- COMPOSITION ----------
     # 1) блок после "Состав/Таркиб" — даже если без двоеточия
-    comp_block = collect_block(lines, "composition")
+    comp_block = cl.composition_block
     if comp_block:
-        comp = extract_composition_from_lines(comp_block)
+        comp = _extract_composition(comp_block)
         if comp:
             parsed["composition"] = comp
             parsed["_meta"]["composition_source"] = "composition_block"
@@ -686,7 +779,7 @@ def parse_bulk_position(texts: List[str]) -> Dict[str, Any]:
 
     # 4) fallback
     if not parsed["composition"]:
-        comp = extract_composition_from_lines(remaining_lines if structured else lines)
+        comp = _extract_composition(remaining_pairs if structured else text_lines)
         if comp: 
             parsed["composition"] = comp
             parsed["_meta"]["composition_source"] = "fallback_from_text"
@@ -1,53 +1,87 @@
 from typing import Dict, Any, List, Optional
 
-_SESSIONS: Dict[int, Dict[str, Any]] = {}
-
 
 # =========================
 # SESSION CORE
 # =========================
 
-def _new_session() -> Dict[str, Any]:
+def _new_menu() -> Dict[str, Any]:
     return {
-        "mode": "idle",  # idle | manual_wait_sheet | manual_menu | dish_collect | edit | bulk_wait_sheet | bulk_collect | bulk_review
-        "menu": {
-            "sheet_url": None,
-            "rows": [],
-        },
-        "texts": [],
-        "photos": [],
-        "parsed": None,
-        "edit_mode": None,
-        "bulk": {
-            "active": False,
-            "buffer": [],        # [{type: "photo"/"text", ...}]
-            "positions": [],     # [{photo, texts, parsed}]
-            "current_index": 0,
-        },
+        "sheet_url": None,
+        "rows": [],
+        "streamed": 0,   # сколько rows уже отдано в фоновую выгрузку
+        "failed": [],    # строки, которые фоновая выгрузка не смогла записать — довыгрузит menu_ready
     }
 
 
-def get_session(user_id: int) -> Optional[Dict[str, Any]]:
+class BulkState:
+    __slots__ = ("active", "buffer", "positions", "current_index")
+
+    def __init__(self, active: bool = False) -> None:
+        self.active = active
+        self.buffer: List[Dict[str, Any]] = []      # [{type: "photo"/"text", ...}]
+        self.positions: List[Dict[str, Any]] = []   # [{photo, texts, parsed, caption_base}]
+        self.current_index = 0
+
+
+class Session:
+    # __slots__ вместо dict: меньше памяти на пользователя и доступ к полям без хэширования ключей.
+    # menu / texts / photos / bulk создаются при первой записи: у пользователя, который только
+    # нажал /start, это None
+    __slots__ = ("mode", "menu", "texts", "photos", "parsed", "edit_mode", "bulk")
+
+    def __init__(self) -> None:
+        self.mode = "idle"  # idle | manual_wait_sheet | manual_menu | dish_collect | edit | bulk_wait_sheet | bulk_collect | bulk_review | menu_export
+        self.menu: Optional[Dict[str, Any]] = None
+        self.texts: Optional[List[str]] = None
+        self.photos: Optional[List[str]] = None
+        self.parsed: Optional[Dict[str, Any]] = None
+        self.edit_mode: Optional[str] = None
+        self.bulk: Optional[BulkState] = None
+
+
+_SESSIONS: Dict[int, Session] = {}
+
+
+def get_session(user_id: int) -> Optional[Session]:
     return _SESSIONS.get(user_id)
 
 
-def ensure_session(user_id: int) -> Dict[str, Any]:
-    if user_id not in _SESSIONS:
-        _SESSIONS[user_id] = _new_session()
-    return _SESSIONS[user_id]
+def ensure_session(user_id: int) -> Session:
+    s = _SESSIONS.get(user_id)
+    if s is None:
+        s = _SESSIONS[user_id] = Session()
+    return s
+
+
+def _session(user_id: int, session: Optional[Session]) -> Session:
+    """Сессия, уже полученная хендлером, либо ensure_session — чтобы не искать user_id повторно."""
+    return session if session is not None else ensure_session(user_id)
+
+
+def _menu(s: Session) -> Dict[str, Any]:
+    if s.menu is None:
+        s.menu = _new_menu()
+    return s.menu
+
+
+def _bulk(s: Session) -> BulkState:
+    if s.bulk is None:
+        s.bulk = BulkState()
+    return s.bulk
 
 
 def clear_session(user_id: int) -> None:
     _SESSIONS.pop(user_id, None)
 
 
-def set_mode(user_id: int, mode: str) -> None:
-    ensure_session(user_id)["mode"] = mode
+def set_mode(user_id: int, mode: str, *, session: Optional[Session] = None) -> None:
+    _session(user_id, session).mode = mode
 
 
-def get_mode(user_id: int) -> str:
-    s = get_session(user_id)
-    return s["mode"] if s else "idle"
+def get_mode(user_id: int, *, session: Optional[Session] = None) -> str:
+    s = session if session is not None else get_session(user_id)
+    return s.mode if s else "idle"
 
 
 # =========================
@@ -56,7 +90,7 @@ def get_mode(user_id: int) -> str:
 
 def start_manual_flow(user_id: int) -> None:
     s = ensure_session(user_id)
-    s["menu"] = {"sheet_url": None, "rows": []}
+    s.menu = _new_menu()
     reset_dish(user_id)
     stop_bulk(user_id)
     set_mode(user_id, "manual_wait_sheet")
@@ -64,49 +98,77 @@ def start_manual_flow(user_id: int) -> None:
 
 def start_bulk_flow(user_id: int) -> None:
     s = ensure_session(user_id)
-    s["menu"] = {"sheet_url": None, "rows": []}
+    s.menu = _new_menu()
     reset_dish(user_id)
     start_bulk(user_id)
     set_mode(user_id, "bulk_wait_sheet")
 
 
-def set_sheet_url(user_id: int, url: str) -> None:
-    ensure_session(user_id)["menu"]["sheet_url"] = url.strip()
+def set_sheet_url(user_id: int, url: str, *, session: Optional[Session] = None) -> None:
+    _menu(_session(user_id, session))["sheet_url"] = url.strip()
+
 
+def add_menu_rows(user_id: int, rows: List[Any], *, session: Optional[Session] = None) -> None:
+    _menu(_session(user_id, session))["rows"].extend(rows)
 
-def add_menu_rows(user_id: int, rows: List[Any]) -> None:
-    ensure_session(user_id)["menu"]["rows"].extend(rows)
+
+def mark_menu_rows_streamed(user_id: int, count: int, *, session: Optional[Session] = None) -> None:
+    _menu(_session(user_id, session))["streamed"] += count
+
+
+def get_unstreamed_menu_rows(menu: Dict[str, Any]) -> List[Any]:
+    return menu["rows"][menu["streamed"]:]
+
+
+# Фоновая выгрузка завершается позже хендлера: пользователь мог уже начать новое меню
+# (start_*_flow, clear_session). Поэтому упавшие строки кладем в тот menu, из которого
+# они ушли, а не в текущий menu пользователя — в новое меню (и в другую таблицу) они не попадут.
+
+def add_failed_menu_rows(menu: Dict[str, Any], rows: List[Any]) -> None:
+    menu["failed"].extend(rows)
+
+
+def take_failed_menu_rows(menu: Dict[str, Any]) -> List[Any]:
+    rows = menu["failed"]
+    menu["failed"] = []
+    return rows
 
 
 # =========================
 # MANUAL DISH
 # =========================
 
-def reset_dish(user_id: int) -> None:
-    s = ensure_session(user_id)
-    s["texts"] = []
-    s["photos"] = []
-    s["parsed"] = None
-    s["edit_mode"] = None
+def reset_dish(user_id: int, *, session: Optional[Session] = None) -> None:
+    s = _session(user_id, session)
+    s.texts = None
+    s.photos = None
+    s.parsed = None
+    s.edit_mode = None
 
 
-def add_text(user_id: int, text: str) -> None:
+def add_text(user_id: int, text: str, *, session: Optional[Session] = None) -> None:
     if not text:
         return
-    ensure_session(user_id)["texts"].append(text.strip())
+    s = _session(user_id, session)
+    if s.texts is None:
+        s.texts = []
+    s.texts.append(text.strip())
 
 
-def add_photo(user_id: int, file_id: str) -> None:
+def add_photo(user_id: int, file_id: str, *, session: Optional[Session] = None) -> None:
     if file_id:
-        ensure_session(user_id)["photos"].append(file_id)
+        s = _session(user_id, session)
+        if s.photos is None:
+            s.photos = []
+        s.photos.append(file_id)
 
 
-def set_parsed(user_id: int, parsed: Dict[str, Any]) -> None:
-    ensure_session(user_id)["parsed"] = parsed
+def set_parsed(user_id: int, parsed: Dict[str, Any], *, session: Optional[Session] = None) -> None:
+    _session(user_id, session).parsed = parsed
 
 
-def set_edit_mode(user_id: int, field: Optional[str]) -> None:
-    ensure_session(user_id)["edit_mode"] = field
+def set_edit_mode(user_id: int, field: Optional[str], *, session: Optional[Session] = None) -> None:
+    _session(user_id, session).edit_mode = field
 
 
 # =========================
@@ -114,53 +176,49 @@ def set_edit_mode(user_id: int, field: Optional[str]) -> None:
 # =========================
 
 def start_bulk(user_id: int) -> None:
-    s = ensure_session(user_id)
-    s["bulk"] = {
-        "active": True,
-        "buffer": [],
-        "positions": [],
-        "current_index": 0,
-    }
+    ensure_session(user_id).bulk = BulkState(active=True)
 
 
 def stop_bulk(user_id: int) -> None:
-    ensure_session(user_id)["bulk"]["active"] = False
+    bulk = ensure_session(user_id).bulk
+    if bulk is not None:
+        bulk.active = False
 
 
 def bulk_is_active(user_id: int) -> bool:
     s = get_session(user_id)
-    return bool(s and s["bulk"]["active"])
+    return bool(s and s.bulk is not None and s.bulk.active)
 
 
 # ---------- COLLECT (ONLY BUFFER) ----------
 
-def bulk_add_photo(user_id: int, photo_obj: Any) -> None:
+def bulk_add_photo(user_id: int, photo_obj: Any, *, session: Optional[Session] = None) -> None:
     """
     photo_obj:
       - {"file_id": "...", "kind": "photo"} или {"file_id": "...", "kind": "document"}
       - либо строка file_id (на всякий случай для старого кода)
     """
-    s = get_session(user_id)
+    s = session if session is not None else get_session(user_id)
     if not s:
         return
 
     if isinstance(photo_obj, str):
         photo_obj = {"file_id": photo_obj, "kind": "photo"}
 
-    s["bulk"]["buffer"].append({
+    _bulk(s).buffer.append({
         "type": "photo",
         "photo": photo_obj,
         "photo_message_id": photo_obj.get("message_id"),  # 👈 ДОБАВИЛИ
     })
 
 
-def bulk_add_text(user_id: int, text: str) -> None:
+def bulk_add_text(user_id: int, text: str, *, session: Optional[Session] = None) -> None:
     if not text:
         return
-    s = get_session(user_id)
+    s = session if session is not None else get_session(user_id)
     if not s:
         return
-    s["bulk"]["buffer"].append({
+    _bulk(s).buffer.append({
         "type": "text",
         "value": text.strip(),
     })
@@ -170,56 +228,56 @@ def bulk_add_text(user_id: int, text: str) -> None:
 
 def bulk_split_into_positions(user_id: int) -> List[Dict[str, Any]]:
     s = ensure_session(user_id)
-    buffer = s["bulk"]["buffer"]
+    bulk = _bulk(s)
+    buffer = bulk.buffer
+
+    # позиция = фото + тексты до следующего фото; тексты до первого фото отбрасываем
+    photo_indices = [i for i, item in enumerate(buffer) if item["type"] == "photo"]
+    ends = photo_indices[1:] + [len(buffer)]
 
     positions: List[Dict[str, Any]] = []
-    current: Optional[Dict[str, Any]] = None
-
-    for item in buffer:
-        if item["type"] == "photo":
-            if current:
-                positions.append(current)
-
-            current = {
-                "photo": item["photo"],
-                "photo_message_id": item.get("photo_message_id"),  # 👈 ДОБАВИЛИ
-                "texts": [],
-                "parsed": None,
-            }
-        else:  # text
-            if current is None:
-                continue
-            current["texts"].append(item["value"])
-
-    if current:
-        positions.append(current)
-
-    s["bulk"]["positions"] = positions
-    s["bulk"]["current_index"] = 0
+    for start, end in zip(photo_indices, ends):
+        item = buffer[start]
+        positions.append({
+            "photo": item["photo"],
+            "photo_message_id": item.get("photo_message_id"),  # 👈 ДОБАВИЛИ
+            "texts": [t["value"] for t in buffer[start + 1:end]],
+            "parsed": None,
+            "caption_base": None,
+        })
+
+    bulk.positions = positions
+    bulk.current_index = 0
     return positions
 
 
 # ---------- REVIEW FLOW ----------
 
 def bulk_total(user_id: int) -> int:
-    return len(ensure_session(user_id)["bulk"]["positions"])
+    bulk = ensure_session(user_id).bulk
+    return len(bulk.positions) if bulk is not None else 0
 
 
 def bulk_get_current(user_id: int) -> Optional[Dict[str, Any]]:
-    s = ensure_session(user_id)
-    idx = s["bulk"]["current_index"]
-    pos = s["bulk"]["positions"]
+    bulk = ensure_session(user_id).bulk
+    if bulk is None:
+        return None
+    idx = bulk.current_index
+    pos = bulk.positions
     if 0 <= idx < len(pos):
         return pos[idx]
     return None
 
 
-def bulk_set_current_parsed(user_id: int, parsed: Dict[str, Any]) -> None:
-    s = ensure_session(user_id)
-    idx = s["bulk"]["current_index"]
-    if 0 <= idx < len(s["bulk"]["positions"]):
-        s["bulk"]["positions"][idx]["parsed"] = parsed
+def bulk_set_current_parsed(user_id: int, parsed: Dict[str, Any], caption_base: Optional[str] = None, *, session: Optional[Session] = None) -> None:
+    bulk = _session(user_id, session).bulk
+    if bulk is None:
+        return
+    idx = bulk.current_index
+    if 0 <= idx < len(bulk.positions):
+        bulk.positions[idx]["parsed"] = parsed
+        bulk.positions[idx]["caption_base"] = caption_base
 
 
-def bulk_next(user_id: int) -> None:
-    ensure_session(user_id)["bulk"]["current_index"] += 1
\ No newline at end of file
+def bulk_next(user_id: int, *, session: Optional[Session] = None) -> None:
+    _bulk(_session(user_id, session)).current_index += 1
\ No newline at end of file
@@ -1,50 +1,264 @@
 import os
+import gzip
+import hashlib
 import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, islice
+from urllib.parse import quote
+
 import gspread
+from gspread.exceptions import APIError
+from gspread.utils import extract_id_from_url
+from gspread.urls import SPREADSHEET_VALUES_APPEND_URL
+from google.auth.transport.requests import AuthorizedSession
 from google.oauth2.service_account import Credentials
+from requests.adapters import HTTPAdapter
+
+try:
+    import orjson  # в requirements.txt; без него (локально) — stdlib json: тело то же, только медленнее
+except ImportError:
+    orjson = None
 
 SCOPES = [
     "https://www.googleapis.com/auth/spreadsheets",
     "https://www.googleapis.com/auth/drive",
 ]
 
+# колонки таблицы по порядку
+FIELDS = ("Позиция", "Описание", "Цена", "Вес", "Код ИКПУ", "Картинка")
+
+# строк на один values:append — запрос к Sheets API не должен разрастаться до лимитов
+APPEND_CHUNK_ROWS = 5000
+
+APPEND_PARAMS = {"valueInputOption": "USER_ENTERED"}
+
+# диапазон без имени листа — первый видимый лист таблицы: ID берем из ссылки, и выгрузке не нужно
+# открывать таблицу (два GET метаданных ради sheet1.title)
+APPEND_RANGE = "A1"
+
+# сколько разных таблиц выгружаем одновременно — больше упремся в квоту записи Sheets API
+EXPORT_CONCURRENCY = 5
+
+# keep-alive соединений к одному хосту: каждому потоку выгрузки свое, с запасом на menu_ready.
+# Сверх пула requests открывает новое соединение и после запроса закрывает его (новый TLS)
+HTTP_POOL_MAXSIZE = EXPORT_CONCURRENCY * 2
+
+# превышение квоты Sheets API (429) — кусок повторяем с экспоненциальной паузой. 5xx не повторяем:
+# values:append не идемпотентен, ответ 5xx мог прийти уже после записи, и повтор задвоил бы строки.
+# Такой кусок падает, и его строки довыгрузит «Меню готово»
+_RETRY_STATUSES = frozenset((429,))
+APPEND_ATTEMPTS = 6
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+
+_JSON_HEADERS = {"Content-Type": "application/json"}
+_GZIP_JSON_HEADERS = {"Content-Type": "application/json", "Content-Encoding": "gzip"}
+
+# тело от GZIP_MIN_BYTES сжимаем: строки меню — повторяющийся текст, gzip ужимает его в разы.
+# Сжатое тело отвергли (4xx) — тот же кусок один раз шлем без сжатия; прошел — значит, дело было
+# в сжатии, и до конца процесса шлем без него
+GZIP_MIN_BYTES = 1024
+_gzip_bodies = True
+
+
+# авторизованный клиент один на процесс: JSON ключа и OAuth не разбираем на каждую выгрузку
+# (токен gspread обновляет сам). Выгрузки идут из to_thread, поэтому создание — под локом
+_client = None
+_client_lock = threading.Lock()
+
 
 def get_client():
-    raw = os.getenv("GOOGLE_CREDENTIALS_JSON")
-    if not raw:
-        raise RuntimeError("GOOGLE_CREDENTIALS_JSON is not set")
+    global _client
+    if _client is not None:
+        return _client
+
+    with _client_lock:
+        if _client is None:
+            raw = os.getenv("GOOGLE_CREDENTIALS_JSON")
+            if not raw:
+                raise RuntimeError("GOOGLE_CREDENTIALS_JSON is not set")
+
+            info = orjson.loads(raw) if orjson is not None else json.loads(raw)
+
+            creds = Credentials.from_service_account_info(
+                info,
+                scopes=SCOPES
+            )
+
+            session = AuthorizedSession(creds)
+            # хостов немного (Sheets API, токен OAuth) — pool_connections хватает маленького
+            session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_MAXSIZE))
+            _client = gspread.authorize(creds, session=session)
+
+    return _client
+
+
+# значения идут как есть, без str(): цена из парсера — int и в JSON уходит голыми цифрами
+# (строка добавила бы кавычки, а USER_ENTERED все равно разберет ее в то же число).
+# Только для старого формата items (dict): строки бота уже кортежи в порядке FIELDS
+def build_fixed_row(item) -> list:
+    """Строка таблицы в порядке FIELDS; отсутствующие поля — пустые."""
+    return [item.get(k, "") for k in FIELDS]
+
 
-    info = json.loads(raw)
+def _as_row(item):
+    # bot.build_sheet_items отдает готовые кортежи в порядке FIELDS; dict — старый формат
+    return item if type(item) is tuple else build_fixed_row(item)
 
-    creds = Credentials.from_service_account_info(
-        info,
-        scopes=SCOPES
+
+def _is_retryable(e: Exception) -> bool:
+    response = getattr(e, "response", None)
+    return isinstance(e, APIError) and response is not None and response.status_code in _RETRY_STATUSES
+
+
+def _dumps(obj) -> bytes:
+    # без orjson — stdlib, но так же компактно и с кириллицей в UTF-8: тело то же, только медленнее
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def _is_client_error(e: Exception) -> bool:
+    # по тексту ошибки отказ от сжатия не отличить (сжатые байты могут уйти прямо в JSON-парсер:
+    # "Invalid JSON payload"), поэтому годится любой 4xx, кроме квоты
+    response = getattr(e, "response", None)
+    return (
+        isinstance(e, APIError)
+        and response is not None
+        and 400 <= response.status_code < 500
+        and response.status_code not in _RETRY_STATUSES
     )
 
-    return gspread.authorize(creds)
+
+def _values_append(http, spreadsheet_id: str, range_label: str, rows) -> None:
+    global _gzip_bodies
+
+    # тело сериализуем (и сжимаем) один раз — повторы шлют те же байты
+    url = SPREADSHEET_VALUES_APPEND_URL % (spreadsheet_id, quote(range_label))
+    body = _dumps({"values": rows})
+    data, headers = body, _JSON_HEADERS
+    if _gzip_bodies and len(body) >= GZIP_MIN_BYTES:
+        data, headers = gzip.compress(body, compresslevel=6), _GZIP_JSON_HEADERS
+
+    attempt = 0
+    gzip_rejected = False
+    while True:
+        try:
+            http.request("post", url, params=APPEND_PARAMS, data=data, headers=headers)
+            if gzip_rejected:
+                # без сжатия прошло — сжатие этот сервер не принимает
+                _gzip_bodies = False
+            return
+        except Exception as e:
+            if headers is _GZIP_JSON_HEADERS and _is_client_error(e):
+                # тот же кусок сразу без сжатия, попытку не засчитываем; упадет и так — ошибка не в gzip
+                gzip_rejected = True
+                data, headers = body, _JSON_HEADERS
+                continue
+            attempt += 1
+            if attempt == APPEND_ATTEMPTS or not _is_retryable(e):
+                raise
+            delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1))
+            time.sleep(delay / 2 + random.uniform(0, delay / 2))
+
+
+def _is_empty_row(row) -> bool:
+    return all(v is None or v == "" for v in row)
 
 
-def open_sheet_by_url(sheet_url: str):
-    client = get_client()
-    spreadsheet = client.open_by_url(sheet_url)
-    return spreadsheet.sheet1
+def _row_fingerprint(row) -> bytes:
+    # по всем колонкам: варианты одной позиции (разный вес/цена) — разные строки
+    # tuple(): кортеж и список с теми же значениями — одна и та же строка
+    return hashlib.blake2b(repr(tuple(row)).encode(), digest_size=8).digest()
+
+
+def _batch_rows(items):
+    """
+    Строки одной пачки items без повторов внутри нее. Пачка — это одна подтвержденная позиция
+    (фоновая выгрузка) или остаток одного меню (export_rows). Дедуп идет до слияния пачек в
+    export_batches: одинаковые строки разных пользователей и разных пачек пишутся все, и между
+    выгрузками ничего не помним — повторная выгрузка меню записывает все строки заново.
+    """
+    seen = set()
+    for row in map(_as_row, items):
+        key = _row_fingerprint(row)
+        if key in seen:
+            continue
+        seen.add(key)
+        yield row
+
+
+def _append(spreadsheet_id: str, rows) -> None:
+    """rows — любой итерируемый объект: строки собираются кусками, весь список в памяти не держим."""
+    # напрямую values:append через http-клиент gspread (та же авторизованная keep-alive сессия),
+    # без модели Worksheet.append_rows
+    http = get_client().http_client
+    rows = iter(rows)
+
+    # куски отправляем по очереди: параллельные append в один лист перемешали бы порядок строк
+    while True:
+        chunk = list(islice(rows, APPEND_CHUNK_ROWS))
+        if not chunk:
+            return
+        # строка из одних пустых ячеек тратит квоту и ничего не пишет — скорее всего, ошибка выше
+        filled = [row for row in chunk if not _is_empty_row(row)]
+        if len(filled) != len(chunk):
+            print(f"⚠️ Пропущено пустых строк для таблицы {spreadsheet_id}: {len(chunk) - len(filled)}")
+        if not filled:
+            continue
+        # повтор — только для упавшего куска, уже записанные не отправляем заново
+        _values_append(http, spreadsheet_id, APPEND_RANGE, filled)
 
 
 def export_rows(sheet_url: str, items):
     if not items:
         return
 
-    sheet = open_sheet_by_url(sheet_url)
-    rows = []
+    _append(extract_id_from_url(sheet_url), _batch_rows(items))
+
+
+def export_batches(batches):
+    """
+    Выгружает несколько пачек [(sheet_url, items), ...] за раз: пачки, попавшие в одну таблицу
+    (разные пользователи, разные ссылки на одну таблицу), уходят одним append.
+
+    Возвращает {индекс пачки: исключение} для пачек, которые выгрузить не удалось.
+    """
+    failed = {}
+    groups = {}  # spreadsheet_id -> ([индексы пачек], [items пачек])
+
+    for i, (sheet_url, items) in enumerate(batches):
+        if not items:
+            continue
+        try:
+            spreadsheet_id = extract_id_from_url(sheet_url)
+        except Exception as e:
+            failed[i] = e
+            continue
+        indices, item_lists = groups.setdefault(spreadsheet_id, ([], []))
+        indices.append(i)
+        item_lists.append(items)
+
+    def _export_group(group):
+        spreadsheet_id, (indices, item_lists) = group
+        try:
+            # строки собираются по ходу отправки, кусок за куском; дубли убираются внутри каждой пачки
+            _append(spreadsheet_id, chain.from_iterable(map(_batch_rows, item_lists)))
+        except Exception as e:
+            for i in indices:
+                failed[i] = e
 
-    for it in items:
-        rows.append([
-            it.get("Позиция", ""),
-            it.get("Описание", ""),
-            it.get("Цена", ""),
-            it.get("Вес", ""),
-            it.get("Код ИКПУ", ""),
-            it.get("Картинка", ""),
-        ])
+    # почти все время append — ожидание ответа Google, поэтому разные таблицы пишем параллельно;
+    # внутри одной таблицы куски по-прежнему идут по очереди
+    if len(groups) <= 1:
+        for group in groups.items():
+            _export_group(group)
+    else:
+        workers = min(EXPORT_CONCURRENCY, len(groups))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(_export_group, groups.items()))
 
-    sheet.append_rows(rows, value_input_option="USER_ENTERED")
\ No newline at end of file
+    return failed